@@ -1,17 +1,24 @@
 import os
-import json
+import time
 import uuid
-from typing import Any, Dict, Iterable, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional
 
-from fastapi import FastAPI, Request
+import orjson
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 
 from app.types import ChatStreamBody
-from app.utils.logger import setup_logger, log_json, get_content_log_config, build_preview, write_session_log
+from app.utils.logger import (
+    setup_logger,
+    log_json,
+    get_content_log_config,
+    maybe_build_preview,
+    write_session_log,
+)
 from app.services.openai_client import OpenAIClient
 from app.services.session_store import SessionStore
-from app.services.prompts import PROMPTS
+from app.services.prompts import PROMPTS, PROMPTS_LISTING
 from dotenv import load_dotenv
 # 已禁用 TTS 集成：不再导入 VoiceClient
 
@@ -19,7 +26,6 @@ from dotenv import load_dotenv
 load_dotenv()  # 加载 .env 环境变量，确保 OPENAI_API_KEY、PORT 等可用
 logger = setup_logger()
 app = FastAPI(title="Chat SSE Service")
-_content_cfg = get_content_log_config()
 
 # CORS 配置
 allowed_origins = os.environ.get("ALLOWED_ORIGINS", "*").split(",")
@@ -31,10 +37,25 @@ app.add_middleware(
     allow_credentials=True,
 )
 
-session_store = SessionStore()
+# 设置 SESSION_STORE_DIR 时会话历史额外追加写入 JSONL 文件，重启后可恢复
+session_store = SessionStore(persist_dir=os.environ.get("SESSION_STORE_DIR") or None)
 client = OpenAIClient()
 
 
+# 模板系统消息在导入时构建并跨请求共享（下游仅读取，不会修改）；
+# 自定义 system 文本来自请求体，不缓存以避免无界增长
+_SYS_CACHE: Dict[str, dict] = {
+    text: {"role": "system", "content": [{"type": "text", "text": text}]} for text in PROMPTS.values()
+}
+
+
+def _sys_msg(text: str) -> dict:
+    m = _SYS_CACHE.get(text)
+    if m is None:
+        m = {"role": "system", "content": [{"type": "text", "text": text}]}
+    return m
+
+
 def build_messages(system_text: Optional[str], history: List[dict], user_input: str) -> List[dict]:
     """
     构建 Responses API 的 input 消息数组。
@@ -49,13 +70,9 @@ def build_messages(system_text: Optional[str], history: List[dict], user_input:
 
     关键逻辑：
         - 每条消息的 content 使用富文本格式：[{"type":"text","text":...}]
+        - 模板系统消息复用预构建的只读字典
     """
-    messages: List[dict] = []
-    if system_text:
-        messages.append({
-            "role": "system",
-            "content": [{"type": "text", "text": system_text}],
-        })
+    messages: List[dict] = [_sys_msg(system_text)] if system_text else []
     # 历史消息直接拼接（已按相同格式保存）
     messages.extend(history)
     messages.append({
@@ -65,79 +82,158 @@ def build_messages(system_text: Optional[str], history: List[dict], user_input:
     return messages
 
 
-def to_sse(event: str, data: Dict[str, Any]) -> str:
+# SSE 帧的固定前后缀预先编码为字节，热路径只需一次 orjson 序列化与拼接
+_SSE_SUFFIX = b"\n\n"
+_SSE_PREFIXES: Dict[str, bytes] = {
+    name: f"event: {name}\ndata: ".encode("utf-8")
+    for name in (
+        "response.created",
+        "message.start",
+        "message.stop",
+        "content.delta",
+        "response.usage",
+        "response.completed",
+        "response.error",
+    )
+}
+_SSE_DELTA_PREFIX = _SSE_PREFIXES["content.delta"]
+
+
+def to_sse(event: str, data: Dict[str, Any]) -> bytes:
     """
-    将事件与数据编码为 SSE 文本块。
+    将事件与数据编码为 SSE 字节块。
 
     输入：
         event: 事件名称
         data: 数据载荷（字典）
 
     输出：
-        str: SSE 块（包含 event 与 data 行，结尾空行）
+        bytes: UTF-8 编码的 SSE 块（包含 event 与 data 行，结尾空行）
     """
-    return f"event: {event}\n" + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    prefix = _SSE_PREFIXES.get(event) or f"event: {event}\ndata: ".encode("utf-8")
+    return prefix + orjson.dumps(data) + _SSE_SUFFIX
+
+
+# 无载荷的结束帧内容固定，导入时编码一次
+_SSE_COMPLETED_FRAME = to_sse("response.completed", {})
+
+# 上游事件类型 -> 处理分支，逐事件只需一次字典查找
+_EV_DELTA, _EV_MESSAGE, _EV_USAGE, _EV_COMPLETED = range(4)
+_EVENT_KINDS: Dict[str, int] = {
+    "content.delta": _EV_DELTA,
+    "response.output_text.delta": _EV_DELTA,
+    "message.start": _EV_MESSAGE,
+    "message.stop": _EV_MESSAGE,
+    "response.usage": _EV_USAGE,
+    "response.completed": _EV_COMPLETED,
+}
 
+# 增量日志按批汇总：每累计 N 条或距上次输出超过 T 秒记录一次
+_DELTA_LOG_BATCH = 32
+_DELTA_LOG_INTERVAL = 0.5
+# 增量预览抽样：记录首条、每第 N 条与末条
+_DELTA_PREVIEW_EVERY = 50
 
-def stream_generator(stream, request_id: str, session_id: Optional[str]) -> Iterable[bytes]:
+
+def _log_delta_preview(request_id: str, session_id: Optional[str], delta: str, seq: int) -> None:
+    """
+    记录单条增量的内容预览（仅在抽样命中时调用）。
     """
-    将 OpenAI 流式事件转为 SSE 输出的生成器。
+    pv = maybe_build_preview("delta", delta)
+    if pv is None:
+        return
+    log_json(logger, 10, "sse.content.delta.preview", requestId=request_id, seq=seq, **pv)
+    write_session_log(session_id, "DEBUG", "sse.content.delta.preview", {"requestId": request_id, "seq": seq, **pv})
+
+
+async def stream_generator(
+    stream,
+    request_id: str,
+    session_id: Optional[str],
+    out: Optional[List[str]] = None,
+    status: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[bytes]:
+    """
+    将 OpenAI 流式事件转为 SSE 输出的异步生成器。
 
     输入：
-        stream: OpenAI responses.stream 返回的可迭代事件对象或模拟流
+        stream: OpenAIClient.astream_response 返回的异步可迭代事件对象或模拟流
         request_id: 本次请求唯一ID
         session_id: 会话ID（可空）
+        out: 可选的收集列表；传入时逐条追加文本增量，供调用方在流结束后拼接完整回复
+        status: 可选的状态字典；上游流正常结束时置 status["completed"] = True，出错时保持未设置
 
     输出：
-        可迭代的字节序列，供 StreamingResponse 使用。
+        异步可迭代的字节序列，供 StreamingResponse 使用。
 
     关键逻辑：
         - 事件映射：统一输出 response.created、message.start、content.delta、message.stop、response.usage、response.completed、response.error。
         - 末尾尝试读取最终 usage 并输出。
+        - 增量日志按批汇总输出，增量预览仅抽样记录，避免逐 token 的日志与磁盘写入。
     """
+    content_cfg = get_content_log_config()
+    preview_delta = content_cfg.get("include_output") in ("delta", "both")
+    delta_count = 0
+    delta_chars = 0
+    logged_count = 0
+    logged_chars = 0
+    last_flush = time.monotonic()
+    last_delta: Optional[str] = None
     # 首事件：meta
     log_json(logger, 20, "sse.response.created", requestId=request_id, sessionId=session_id)
     write_session_log(session_id, "INFO", "sse.response.created", {"requestId": request_id})
-    yield to_sse("response.created", {"requestId": request_id, "sessionId": session_id}).encode("utf-8")
+    yield to_sse("response.created", {"requestId": request_id, "sessionId": session_id})
     try:
-        for event in stream:
-            etype = getattr(event, "type", None) or getattr(event, "event_type", None) or ""
+        async for event in stream:
+            etype = getattr(event, "type", None)
+            kind = _EVENT_KINDS.get(etype)
+            if kind is None:
+                # 未登记的类型：兼容 event_type 属性与其他 *.delta 事件，其余忽略
+                etype = etype or getattr(event, "event_type", None) or ""
+                kind = _EVENT_KINDS.get(etype, _EV_DELTA if "delta" in etype else None)
+                if kind is None:
+                    # 可选：yield to_sse("debug.event", {"type": etype})
+                    continue
             data = getattr(event, "data", None)
+            if not isinstance(data, dict):
+                data = None
             # 文本增量
-            if "delta" in etype or etype in ("content.delta", "response.output_text.delta"):
-                delta = None
-                if data and isinstance(data, dict):
+            if kind == _EV_DELTA:
+                if data is not None:
                     delta = data.get("delta") or data.get("text")
                 else:
                     delta = getattr(event, "delta", None)
-                if delta:
-                    log_json(logger, 10, "sse.content.delta", requestId=request_id, len=len(delta))
-                    # 可选：记录增量预览
-                    if _content_cfg.get("include_output") in ("delta", "both"):
-                        pv = build_preview(delta, _content_cfg["max_chars"], _content_cfg["redact"])
-                        log_json(logger, 10, "sse.content.delta.preview", requestId=request_id, **pv)
-                        write_session_log(session_id, "DEBUG", "sse.content.delta.preview", {"requestId": request_id, **pv})
-                    yield to_sse("content.delta", {"text": delta}).encode("utf-8")
+                if not delta:
                     continue
+                delta_count += 1
+                delta_chars += len(delta)
+                last_delta = delta
+                if out is not None:
+                    out.append(delta)
+                now = time.monotonic()
+                if delta_count - logged_count >= _DELTA_LOG_BATCH or now - last_flush > _DELTA_LOG_INTERVAL:
+                    log_json(logger, 10, "sse.content.delta.batch", requestId=request_id, count=delta_count - logged_count, len=delta_chars - logged_chars)
+                    logged_count, logged_chars, last_flush = delta_count, delta_chars, now
+                # 可选：抽样记录增量预览
+                if preview_delta and (delta_count == 1 or delta_count % _DELTA_PREVIEW_EVERY == 0):
+                    _log_delta_preview(request_id, session_id, delta, delta_count)
+                yield _SSE_DELTA_PREFIX + orjson.dumps({"text": delta}) + _SSE_SUFFIX
             # 直接透传已知事件
-            if etype in ("message.start", "message.stop"):
+            elif kind == _EV_MESSAGE:
                 log_json(logger, 10, "sse.message", requestId=request_id, type=etype)
-                yield to_sse(etype, data if isinstance(data, dict) else {}).encode("utf-8")
-                continue
-            if etype in ("response.usage",):
-                try:
-                    usage = data if isinstance(data, dict) else {}
-                except Exception:
-                    usage = {}
+                yield to_sse(etype, data or {})
+            elif kind == _EV_USAGE:
+                usage = data or {}
                 log_json(logger, 20, "sse.response.usage", requestId=request_id, **usage)
-                yield to_sse("response.usage", data if isinstance(data, dict) else {}).encode("utf-8")
-                continue
-            if etype in ("response.completed",):
+                yield to_sse("response.usage", usage)
+            else:
                 log_json(logger, 20, "sse.response.completed", requestId=request_id)
-                yield to_sse("response.completed", data if isinstance(data, dict) else {}).encode("utf-8")
-                continue
-            # 未知事件：忽略或记录
-            # 可选：yield to_sse("debug.event", {"type": etype, "data": data or {}}).encode("utf-8")
+                yield to_sse("response.completed", data or {})
+        # 输出剩余未汇总的增量统计与末条预览
+        if delta_count > logged_count:
+            log_json(logger, 10, "sse.content.delta.batch", requestId=request_id, count=delta_count - logged_count, len=delta_chars - logged_chars)
+        if preview_delta and last_delta and delta_count > 1 and delta_count % _DELTA_PREVIEW_EVERY != 0:
+            _log_delta_preview(request_id, session_id, last_delta, delta_count)
         # 最终响应（包含 usage）
         try:
             final = stream.get_final_response()
@@ -152,25 +248,33 @@ def stream_generator(stream, request_id: str, session_id: Optional[str]) -> Iter
             if usage:
                 log_json(logger, 20, "sse.response.usage.final", requestId=request_id, **(usage if isinstance(usage, dict) else {}))
                 write_session_log(session_id, "INFO", "sse.response.usage.final", {"requestId": request_id, **(usage if isinstance(usage, dict) else {})})
-                yield to_sse("response.usage", usage if isinstance(usage, dict) else {}).encode("utf-8")
+                yield to_sse("response.usage", usage if isinstance(usage, dict) else {})
             # 可选：记录最终输出预览
-            if _content_cfg.get("include_output") in ("final", "both") and final_text:
-                pv = build_preview(final_text, _content_cfg["max_chars"], _content_cfg["redact"])
+            pv = maybe_build_preview("final", final_text) if final_text else None
+            if pv is not None:
                 log_json(logger, 20, "sse.output.final.preview", requestId=request_id, **pv)
                 write_session_log(session_id, "INFO", "sse.output.final.preview", {"requestId": request_id, **pv})
         except Exception:
             pass
         log_json(logger, 20, "sse.response.completed.final", requestId=request_id)
         write_session_log(session_id, "INFO", "sse.response.completed.final", {"requestId": request_id})
-        yield to_sse("response.completed", {}).encode("utf-8")
+        if status is not None:
+            status["completed"] = True
+        yield _SSE_COMPLETED_FRAME
     except Exception as e:
         # 错误时记录输出状态（可选）
         log_json(logger, 40, "sse.response.error", requestId=request_id, error=str(e))
         write_session_log(session_id, "ERROR", "sse.response.error", {"requestId": request_id, "error": str(e)})
-        yield to_sse("response.error", {"message": str(e)}).encode("utf-8")
+        yield to_sse("response.error", {"message": str(e)})
 
 
-def stream_text_only(stream, request_id: str, session_id: Optional[str]) -> Iterable[bytes]:
+async def stream_text_only(
+    stream,
+    request_id: str,
+    session_id: Optional[str],
+    out: Optional[List[str]] = None,
+    status: Optional[Dict[str, Any]] = None,
+) -> AsyncIterator[bytes]:
     """
     仅输出文本事件的 SSE 生成器（不再调用 TTS，也不输出音频事件）。
 
@@ -178,11 +282,13 @@ def stream_text_only(stream, request_id: str, session_id: Optional[str]) -> Iter
         stream: 文本生成事件流（OpenAI）
         request_id: 请求ID
         session_id: 会话ID
+        out: 可选的文本增量收集列表（透传给 stream_generator）
+        status: 可选的完成状态字典（透传给 stream_generator）
 
     输出：
         只包含文本相关事件：content.delta、response.usage、response.completed、error。
     """
-    for chunk in stream_generator(stream, request_id, session_id):
+    async for chunk in stream_generator(stream, request_id, session_id, out, status):
         yield chunk
 
 
@@ -197,12 +303,19 @@ def healthz():
     return {"status": "ok"}
 
 
+# 模板接口内容为静态数据，导入时预先编码为 JSON 字节，请求时直接返回
+_PROMPTS_LISTING_BYTES = orjson.dumps(PROMPTS_LISTING)
+_PROMPT_BYTES: Dict[str, bytes] = {
+    name: orjson.dumps({"name": name, "text": text}) for name, text in PROMPTS.items() if text
+}
+
+
 @app.get("/prompts")
 def list_prompts():
     """
-    列出可用的 System Prompt 模板名与摘要。
+    列出可用的 System Prompt 模板名与摘要（导入时预先编码）。
     """
-    return {"prompts": [{"name": k, "preview": PROMPTS[k][:40]} for k in PROMPTS.keys()]}
+    return Response(content=_PROMPTS_LISTING_BYTES, media_type="application/json")
 
 
 @app.get("/prompts/{name}")
@@ -210,20 +323,18 @@ def get_prompt(name: str):
     """
     获取指定模板文本。
     """
-    text = PROMPTS.get(name)
-    if not text:
+    content = _PROMPT_BYTES.get(name)
+    if content is None:
         return JSONResponse(status_code=404, content={"error": "prompt not found"})
-    return {"name": name, "text": text}
+    return Response(content=content, media_type="application/json")
 
 
-@app.post("/chat/stream")
-async def chat_stream_post(body: ChatStreamBody, request: Request):
+async def _serve_stream(body: ChatStreamBody) -> StreamingResponse:
     """
-    SSE 主入口（POST），与 OpenAI Responses API 风格一致。
+    POST 与 GET 入口共用的 SSE 处理逻辑。
 
     输入：
-        body: ChatStreamBody，请求体
-        request: FastAPI 请求对象（用于访问头等）
+        body: ChatStreamBody，已解析的请求参数
 
     输出：
         StreamingResponse：`text/event-stream`，按事件流式返回。
@@ -234,13 +345,15 @@ async def chat_stream_post(body: ChatStreamBody, request: Request):
         - lifecycle：生成 requestId 并记录日志；
         - 输出事件对齐：response.created、delta、usage、completed、error。
     """
-    request_id = str(uuid.uuid4())
+    request_id = uuid.uuid4().hex
     session_id = body.sessionId
     system_text = body.system or PROMPTS.get(body.systemPromptName or "default")
+    # 未传 sessionId 时以 requestId 作为会话键：客户端无法再次引用，只保留在内存中，不持久化
+    persist = bool(session_id)
 
     # 历史：优先使用 body.messages，否则从 sessionStore 获取
     if body.messages:
-        session_store.set(session_id or request_id, body.messages)
+        session_store.set(session_id or request_id, body.messages, persist=persist)
         history = body.messages
     else:
         history = session_store.get(session_id or request_id)
@@ -250,28 +363,46 @@ async def chat_stream_post(body: ChatStreamBody, request: Request):
     log_json(logger, 20, "request.start", requestId=request_id, sessionId=session_id, path="/chat/stream")
     write_session_log(session_id, "INFO", "request.start", {"requestId": request_id, "path": "/chat/stream"})
     # 可选：记录输入预览
-    if _content_cfg.get("include_input"):
-        # 提取当前用户输入（忽略历史）
-        pv = build_preview(body.input, _content_cfg["max_chars"], _content_cfg["redact"])
+    # 仅预览当前用户输入（忽略历史）
+    pv = maybe_build_preview("input", body.input)
+    if pv is not None:
         log_json(logger, 20, "request.input.preview", requestId=request_id, messages=len(messages), **pv)
         write_session_log(session_id, "INFO", "request.input.preview", {"requestId": request_id, "messages": len(messages), **pv})
-    stream = client.stream_response(messages, body.temperature or 0.7)
+    stream = await client.astream_response(messages, body.temperature or 0.7)
 
-    async def run_stream() -> Iterable[bytes]:
-        # 生成器本身是同步的，这里直接迭代即可
-        for chunk in stream_text_only(stream, request_id, session_id):
+    async def run_stream() -> AsyncIterator[bytes]:
+        reply_parts: List[str] = []
+        status: Dict[str, Any] = {}
+        # 异步迭代上游事件：等待网络数据期间事件循环可服务其他连接
+        async for chunk in stream_text_only(stream, request_id, session_id, reply_parts, status):
             yield chunk
         # 记录结束日志
         log_json(logger, 20, "request.end", requestId=request_id, sessionId=session_id)
         write_session_log(session_id, "INFO", "request.end", {"requestId": request_id})
-        # 写入会话历史：将最后一轮助手回复粗略追加（此处近似，真实可在收集完整文本后追加）
-        # 简化：不在生成器中收集全文，后续可优化。
-        # 这里只追加一个占位，避免误删历史。
-        session_store.append(session_id or request_id, {"role": "assistant", "content": [{"type": "text", "text": "(流式回复已发送)"}]})
+        # 写入会话历史：仅在上游流正常结束时成对追加本轮用户输入与完整助手回复（中途失败的截断回复不写入）
+        if status.get("completed") and reply_parts:
+            session_store.extend(session_id or request_id, [
+                {"role": "user", "content": [{"type": "text", "text": body.input}]},
+                {"role": "assistant", "content": [{"type": "text", "text": "".join(reply_parts)}]},
+            ], persist=persist)
 
     return StreamingResponse(run_stream(), media_type="text/event-stream")
 
 
+@app.post("/chat/stream")
+async def chat_stream_post(body: ChatStreamBody):
+    """
+    SSE 主入口（POST），与 OpenAI Responses API 风格一致。
+
+    输入：
+        body: ChatStreamBody，请求体
+
+    输出：
+        StreamingResponse：`text/event-stream`，按事件流式返回。
+    """
+    return await _serve_stream(body)
+
+
 @app.get("/chat/stream")
 async def chat_stream_get(input: str, sessionId: Optional[str] = None, system: Optional[str] = None, systemPromptName: Optional[str] = None, temperature: Optional[float] = 0.7):
     """
@@ -288,8 +419,5 @@ async def chat_stream_get(input: str, sessionId: Optional[str] = None, system: O
         StreamingResponse：`text/event-stream`。
     """
     body = ChatStreamBody(input=input, sessionId=sessionId, system=system, systemPromptName=systemPromptName, temperature=temperature)
-    # 复用 POST 处理逻辑，同时传递 Query 参数 voiceId（若存在）
-    req = Request(scope={"type": "http"})
-    # FastAPI TestClient/Request 在此场景下 query_params 为空，这里不强制注入；
-    # 前端若需 GET 使用 voiceId，建议改为 POST 传递或使用 Header。
-    return await chat_stream_post(body, req)
\ No newline at end of file
+    # 与 POST 共用处理逻辑，无需构造伪 Request
+    return await _serve_stream(body)
\ No newline at end of file
@@ -1,6 +1,7 @@
 import os
-import json
-from typing import Any, Dict, Iterable, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from openai import AsyncOpenAI
 
 from app.utils.retry import retry_with_backoff
 
@@ -18,20 +19,27 @@ class MockEvent:
 class MockStream:
     """
     模拟的事件流，便于在无 API Key 环境下本地验证 SSE。
+
+    参数：
+        reply_text: 模拟回复文本
+        chunk_size: 每个增量事件包含的字符数，默认 8（接近真实 token 粒度）
     """
 
-    def __init__(self, reply_text: str):
+    def __init__(self, reply_text: str, chunk_size: int = 8):
         self.reply_text = reply_text
+        self.chunk_size = chunk_size
 
-    def __iter__(self):
+    def __aiter__(self):
         return self.events()
 
-    def events(self) -> Iterable[MockEvent]:
+    async def events(self) -> AsyncIterator[MockEvent]:
         yield MockEvent("response.created", {"id": "mock-001"})
         yield MockEvent("message.start", {})
-        # 逐字/逐段输出
-        for ch in self.reply_text:
-            yield MockEvent("content.delta", {"delta": ch})
+        # 按 chunk_size 分段输出
+        text = self.reply_text
+        step = self.chunk_size
+        for i in range(0, len(text), step):
+            yield MockEvent("content.delta", {"delta": text[i : i + step]})
         yield MockEvent("message.stop", {})
         usage = {"input_tokens": 0, "output_tokens": len(self.reply_text), "total_tokens": len(self.reply_text)}
         yield MockEvent("response.usage", usage)
@@ -41,50 +49,51 @@ class MockStream:
         return {"usage": {"input_tokens": 0, "output_tokens": len(self.reply_text), "total_tokens": len(self.reply_text)}}
 
 
+def _content_text(content: Any) -> str:
+    """
+    提取消息 content 的纯文本：字符串原样返回；Responses 风格 [{type:text, text:...}] 拼接各段 text。
+    """
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(c.get("text", "") for c in content if isinstance(c, dict) and c.get("type") == "text")
+    return ""
+
+
+def convert_to_chat_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    将 Responses 风格的消息数组转换为 Chat Completions 的 {role, content: str} 格式。
+    """
+    return [{"role": m.get("role"), "content": _content_text(m.get("content"))} for m in messages]
+
+
 class OpenAIClient:
     """
     OpenAI 客户端封装，负责发起 Responses API 流式请求。
 
     方法：
-        stream_response(input_messages, temperature): 返回可迭代事件流对象
+        astream_response(input_messages, temperature): 返回异步可迭代事件流对象
 
     关键逻辑：
         - 当环境变量 USE_MOCK=1 时，返回模拟事件流。
-        - 正常情况下调用 OpenAI 官方 SDK 的 responses.stream 接口，启用 include_usage。
+        - 正常情况下通过 AsyncOpenAI 发起流式请求，等待网络数据时不阻塞事件循环。
     """
 
     def __init__(self, api_key: Optional[str] = None):
         self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
         self.use_mock = os.environ.get("USE_MOCK", "0") == "1"
+        # 无密钥时不创建 SDK 客户端（AsyncOpenAI 在缺少密钥时会直接抛错）
+        self._async_client = AsyncOpenAI(api_key=self.api_key) if self.api_key else None
 
     @retry_with_backoff()
-    def _stream_impl(self, input_messages: List[Dict[str, Any]], temperature: float):
-        if self.use_mock or not self.api_key:
+    async def _stream_impl(self, input_messages: List[Dict[str, Any]], temperature: float):
+        if self.use_mock or self._async_client is None:
             return MockStream("这是一个模拟流式回复，用于本地验证SSE。")
         # 使用 Chat Completions 流式作为兼容实现
-        from openai import OpenAI
-
-        def convert_to_chat_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-            chat_msgs: List[Dict[str, Any]] = []
-            for m in messages:
-                role = m.get("role")
-                content = m.get("content")
-                text = ""
-                if isinstance(content, list):
-                    # Responses 风格 [{type:text, text:...}] -> 提取 text
-                    for c in content:
-                        if isinstance(c, dict) and c.get("type") == "text":
-                            text += c.get("text", "")
-                elif isinstance(content, str):
-                    text = content
-                chat_msgs.append({"role": role, "content": text})
-            return chat_msgs
-
-        client = OpenAI(api_key=self.api_key)
         chat_messages = convert_to_chat_messages(input_messages)
         # 返回一个适配器，将 Chat Completions 的流事件转为统一的 MockEvent 风格
         return ChatCompletionsStreamAdapter(
-            client.chat.completions.create(
+            await self._async_client.chat.completions.create(
                 model="gpt-4o-mini",
                 messages=chat_messages,
                 temperature=temperature,
@@ -92,18 +101,18 @@ class OpenAIClient:
             )
         )
 
-    def stream_response(self, input_messages: List[Dict[str, Any]], temperature: float = 0.7):
+    async def astream_response(self, input_messages: List[Dict[str, Any]], temperature: float = 0.7):
         """
-        发起流式请求。
+        发起异步流式请求。
 
         输入：
             input_messages: Responses API 的 input 消息数组（包含系统、历史与当前用户消息）
             temperature: 采样温度，默认 0.7
 
         输出：
-            事件流对象，可被迭代获取事件。
+            事件流对象，可通过 async for 迭代获取事件。
         """
-        return self._stream_impl(input_messages, temperature)
+        return await self._stream_impl(input_messages, temperature)
 
 
 class ChatCompletionsStreamAdapter:
@@ -115,34 +124,35 @@ class ChatCompletionsStreamAdapter:
 
     使用统计：
         Chat Completions 流式通常不直接提供 usage，这里提供近似统计（输出字符数）。
+        仅累计字符数，不保留增量文本（完整回复由调用方按需收集）。
     """
 
-    def __init__(self, generator):
-        self._gen = generator
-        self._buffer = []  # 收集最终文本
+    def __init__(self, stream):
+        self._stream = stream  # AsyncOpenAI 返回的 AsyncStream
+        self._out_len = 0  # 已输出字符数
 
-    def __iter__(self):
+    def __aiter__(self):
         return self.events()
 
-    def events(self) -> Iterable[MockEvent]:
+    async def events(self) -> AsyncIterator[MockEvent]:
         yield MockEvent("response.created", {"id": "chatcmpl-stream"})
         yield MockEvent("message.start", {})
-        for chunk in self._gen:
-            try:
-                choice = chunk.choices[0]
-                delta_text = getattr(choice.delta, "content", None)
-                if delta_text:
-                    self._buffer.append(delta_text)
-                    yield MockEvent("content.delta", {"delta": delta_text})
-            except Exception:
-                # 保护性忽略异常块
+        async for chunk in self._stream:
+            # 显式跳过无 choices / 无 delta 的块（如 usage 块），不在逐块循环里包 try/except
+            choices = chunk.choices
+            if not choices:
                 continue
+            delta_obj = choices[0].delta
+            delta_text = delta_obj.content if delta_obj is not None else None
+            if delta_text:
+                self._out_len += len(delta_text)
+                yield MockEvent("content.delta", {"delta": delta_text})
         yield MockEvent("message.stop", {})
-        text = "".join(self._buffer)
-        usage = {"input_tokens": 0, "output_tokens": len(text), "total_tokens": len(text)}
-        yield MockEvent("response.usage", usage)
+        yield MockEvent("response.usage", self._usage())
         yield MockEvent("response.completed", {})
 
+    def _usage(self) -> Dict[str, Any]:
+        return {"input_tokens": 0, "output_tokens": self._out_len, "total_tokens": self._out_len}
+
     def get_final_response(self) -> Dict[str, Any]:
-        text = "".join(self._buffer)
-        return {"usage": {"input_tokens": 0, "output_tokens": len(text), "total_tokens": len(text)}}
\ No newline at end of file
+        return {"usage": self._usage()}
\ No newline at end of file
@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Any, Dict
 
 
 PROMPTS: Dict[str, str] = {
@@ -12,4 +12,10 @@ PROMPTS: Dict[str, str] = {
     "coder": (
         "你是一名资深工程师，回答中优先给出可执行的代码、命令和步骤。"
     ),
+}
+
+
+# 模板列表（名称 + 摘要）为常量输入的纯函数结果，导入时预先构建，接口直接返回
+PROMPTS_LISTING: Dict[str, Any] = {
+    "prompts": [{"name": k, "preview": v[:40]} for k, v in PROMPTS.items()],
 }
\ No newline at end of file
@@ -1,52 +1,266 @@
+import atexit
+import hashlib
+import os
+import queue
+import re
+import threading
 import time
-from typing import Dict, List, Any
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import orjson
+from cachetools import TTLCache
+
+# 会话ID可直接用作文件名的字符集；其余ID取哈希，避免路径穿越
+_SAFE_SESSION_ID = re.compile(r"[A-Za-z0-9_-]{1,128}")
+
+
+class _JsonlWriter:
+    """
+    会话持久化写线程：按会话追加 JSONL，空闲时清理过期文件。
+
+    说明：
+        - 请求路径只负责入队，序列化与写入都在写线程内完成，单线程顺序写入保证同一会话的写入顺序；
+        - 无法序列化的消息（如超过 64 位的整数、孤立代理字符）整批跳过，不影响请求；
+        - append 追加一行并不 fsync；行数超过 compact_lines 时在写线程内压缩为最近 keep_lines 行；
+        - 队列空闲超过 cleanup_interval 后，删除最后修改时间早于 ttl_seconds 的会话文件；
+        - 启动时扫描目录建立已有文件索引，写入时加入、清理与过期时移除：
+          没有文件的会话在 load 时直接返回，不产生文件系统调用。
+    """
+
+    def __init__(self, base_dir: str, ttl_seconds: int, keep_lines: int, cleanup_interval: float = 60.0):
+        self.base_dir = base_dir
+        self.ttl_seconds = ttl_seconds
+        self.keep_lines = keep_lines
+        self.compact_lines = keep_lines * 2
+        self.cleanup_interval = cleanup_interval
+        self._queue: "queue.Queue[Optional[Tuple[str, str, List[dict]]]]" = queue.Queue()
+        self._line_counts: Dict[str, int] = {}
+        os.makedirs(base_dir, exist_ok=True)
+        self._known = {entry.path for entry in os.scandir(base_dir) if entry.name.endswith(".jsonl")}
+        self._thread = threading.Thread(target=self._run, name="session-store-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def path_for(self, session_id: str) -> str:
+        if _SAFE_SESSION_ID.fullmatch(session_id):
+            name = session_id
+        else:
+            name = "h-" + hashlib.sha1(session_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.base_dir, f"{name}.jsonl")
+
+    def has_file(self, session_id: str) -> bool:
+        return self.path_for(session_id) in self._known
+
+    def append(self, session_id: str, messages: List[dict]) -> None:
+        path = self.path_for(session_id)
+        self._known.add(path)
+        self._queue.put_nowait(("append", path, messages))
+
+    def replace(self, session_id: str, messages: List[dict]) -> None:
+        path = self.path_for(session_id)
+        self._known.add(path)
+        self._queue.put_nowait(("replace", path, messages))
+
+    def load(self, session_id: str) -> Optional[List[dict]]:
+        """
+        读取会话文件中最近 keep_lines 条消息；文件不存在或已过期返回 None。
+        """
+        path = self.path_for(session_id)
+        if path not in self._known:
+            return None
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                self._known.discard(path)
+                return None
+            with open(path, "rb") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            self._known.discard(path)
+            return None
+        messages: List[dict] = []
+        for line in lines[-self.keep_lines :]:
+            try:
+                messages.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                # 进程中断可能留下半行，跳过
+                continue
+        return messages
+
+    def flush(self) -> None:
+        """
+        阻塞等待已入队的写入全部完成。
+        """
+        self._queue.put(None)
+        self._queue.join()
+
+    def _write(self, op: str, path: str, messages: List[dict]) -> None:
+        # 先整批序列化：任一消息失败则整批不落盘，避免文件中只留下半轮对话
+        data = b"".join(orjson.dumps(m, option=orjson.OPT_APPEND_NEWLINE) for m in messages)
+        # 清理可能在入队后移除了索引项，写入时重新登记
+        self._known.add(path)
+        if op == "replace":
+            with open(path, "wb") as f:
+                f.write(data)
+            self._line_counts[path] = len(messages)
+            return
+        with open(path, "ab") as f:
+            f.write(data)
+        count = self._line_counts.get(path)
+        if count is None:
+            # 首次写入该路径（如重启后续写已有文件）：统计追加后的实际行数，使压缩计入已在磁盘上的行
+            with open(path, "rb") as f:
+                count = f.read().count(b"\n")
+        else:
+            count += len(messages)
+        if count > self.compact_lines:
+            with open(path, "rb") as f:
+                tail = f.read().splitlines(keepends=True)[-self.keep_lines :]
+            with open(path, "wb") as f:
+                f.writelines(tail)
+            count = len(tail)
+        self._line_counts[path] = count
+
+    def _cleanup(self) -> None:
+        cutoff = time.time() - self.ttl_seconds
+        try:
+            entries = list(os.scandir(self.base_dir))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.name.endswith(".jsonl") and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    self._known.discard(entry.path)
+                    self._line_counts.pop(entry.path, None)
+            except OSError:
+                continue
+
+    def _run(self) -> None:
+        q = self._queue
+        last_cleanup = time.monotonic()
+        while True:
+            try:
+                item = q.get(timeout=self.cleanup_interval)
+            except queue.Empty:
+                item = None
+            else:
+                try:
+                    if item is not None:
+                        self._write(*item)
+                except Exception:
+                    # 序列化或持久化失败不影响内存会话
+                    pass
+                finally:
+                    q.task_done()
+            if item is None and time.monotonic() - last_cleanup >= self.cleanup_interval:
+                self._cleanup()
+                last_cleanup = time.monotonic()
 
 
 class SessionStore:
     """
-    内存会话存储，支持 TTL 与窗口限制。
+    内存会话存储，支持 TTL 与窗口限制，可选追加式 JSONL 持久化。
 
     说明：
-        - 使用字典维护 sessionId -> {messages: List[dict], ts: float}
+        - 使用 cachetools.TTLCache 维护 sessionId -> deque(messages)，过期与容量淘汰由缓存惰性批量处理
+        - 每个会话的消息窗口为 deque(maxlen=max_rounds*2)，追加 O(1)，超出窗口自动丢弃最旧消息
+        - 按 hash(sessionId) 分片，每个分片独立加锁：同一会话的读改写是原子的，不同会话的写入互不争用
+        - 传入 persist_dir 时：内存仍为读取的权威来源，写入额外入队到后台线程追加到
+          `<persist_dir>/<sessionId>.jsonl`；进程重启后在首次 get 未命中时从文件懒加载
+          （仅对索引中存在文件的会话，文件读取不持有分片锁）
         - 每条消息结构与 Responses API 的 input 消息格式一致（role+content）。
 
     参数：
-        ttl_seconds: 会话存活时间，默认 7200 秒（2 小时）
+        ttl_seconds: 会话存活时间，默认 7200 秒（2 小时）；每次写入刷新
         max_rounds: 保留的最近轮数，默认 10
+        max_sessions: 同时保留的最大会话数，默认 10000（均分到各分片，超出按 LRU 淘汰）
+        shards: 分片数，默认 16
+        persist_dir: 持久化目录（为空则仅内存）
 
     方法：
-        get(session_id): 返回消息历史（过期则清理）
+        get(session_id): 返回消息历史快照（过期则视为空）
         append(session_id, message): 追加消息
-        set(session_id, messages): 设置完整历史
+        extend(session_id, messages, persist=True): 原子地追加多条消息（如一轮 user+assistant）
+        set(session_id, messages, persist=True): 设置完整历史
+        （persist=False 时仅写内存，用于服务端生成、客户端无法再次引用的会话ID）
+        flush(): 等待持久化写入完成
     """
 
-    def __init__(self, ttl_seconds: int = 7200, max_rounds: int = 10):
+    def __init__(
+        self,
+        ttl_seconds: int = 7200,
+        max_rounds: int = 10,
+        max_sessions: int = 10000,
+        shards: int = 16,
+        persist_dir: Optional[str] = None,
+    ):
         self.ttl_seconds = ttl_seconds
         self.max_rounds = max_rounds
-        self.store: Dict[str, Dict[str, Any]] = {}
+        per_shard = max(1, max_sessions // shards)
+        self._shards: List[Tuple[TTLCache, threading.Lock]] = [
+            (TTLCache(maxsize=per_shard, ttl=ttl_seconds), threading.Lock()) for _ in range(shards)
+        ]
+        self._writer = _JsonlWriter(persist_dir, ttl_seconds, max_rounds * 2) if persist_dir else None
+
+    def _shard(self, session_id: str) -> Tuple[TTLCache, threading.Lock]:
+        return self._shards[hash(session_id) % len(self._shards)]
 
-    def _is_expired(self, ts: float) -> bool:
-        return (time.time() - ts) > self.ttl_seconds
+    def _restore(self, store: TTLCache, lock: threading.Lock, session_id: str) -> bool:
+        # 内存未命中时从持久化文件懒加载：无文件的会话直接返回；文件读取在分片锁之外进行
+        if self._writer is None or not self._writer.has_file(session_id):
+            return False
+        loaded = self._writer.load(session_id)
+        if not loaded:
+            return False
+        with lock:
+            # 读取期间可能已有并发写入，以内存为准
+            if store.get(session_id) is None:
+                store[session_id] = deque(loaded, maxlen=self.max_rounds * 2)
+        return True
 
     def get(self, session_id: str) -> List[dict]:
-        data = self.store.get(session_id)
-        if not data:
-            return []
-        if self._is_expired(data["ts"]):
-            del self.store[session_id]
+        store, lock = self._shard(session_id)
+        with lock:
+            messages = store.get(session_id)
+            if messages is not None:
+                # 返回快照，避免调用方迭代时与并发追加冲突
+                return list(messages)
+        if not self._restore(store, lock, session_id):
             return []
-        return data["messages"]
+        with lock:
+            messages = store.get(session_id)
+            return list(messages) if messages else []
 
     def append(self, session_id: str, message: dict) -> None:
-        messages = self.get(session_id)
-        messages.append(message)
-        # 窗口限制：仅保留最近 max_rounds*2 条（user+assistant 成对）
-        if len(messages) > self.max_rounds * 2:
-            messages = messages[-self.max_rounds * 2 :]
-        self.store[session_id] = {"messages": messages, "ts": time.time()}
-
-    def set(self, session_id: str, messages: List[dict]) -> None:
+        self.extend(session_id, [message])
+
+    def extend(self, session_id: str, new_messages: List[dict], persist: bool = True) -> None:
+        store, lock = self._shard(session_id)
+        with lock:
+            missing = store.get(session_id) is None
+        if missing:
+            self._restore(store, lock, session_id)
+        with lock:
+            messages = store.get(session_id)
+            if messages is None:
+                messages = deque(maxlen=self.max_rounds * 2)
+            # 窗口限制：deque 仅保留最近 max_rounds*2 条（user+assistant 成对）
+            messages.extend(new_messages)
+            # 重新写入以刷新 TTL
+            store[session_id] = messages
+            if persist and self._writer is not None:
+                self._writer.append(session_id, list(new_messages))
+
+    def set(self, session_id: str, messages: List[dict], persist: bool = True) -> None:
         # 直接设置历史（例如从请求体传入 messages 覆盖）
-        if len(messages) > self.max_rounds * 2:
-            messages = messages[-self.max_rounds * 2 :]
-        self.store[session_id] = {"messages": messages, "ts": time.time()}
\ No newline at end of file
+        store, lock = self._shard(session_id)
+        window = deque(messages, maxlen=self.max_rounds * 2)
+        with lock:
+            store[session_id] = window
+            if persist and self._writer is not None:
+                self._writer.replace(session_id, list(window))
+
+    def flush(self) -> None:
+        if self._writer is not None:
+            self._writer.flush()
\ No newline at end of file
@@ -1,10 +1,81 @@
+import atexit
+import functools
 import os
-import base64
+import threading
+from pathlib import Path
 from typing import Iterable, Dict, Any, Optional
 
+from app.utils.logger import log_json, setup_logger, maybe_build_preview, write_session_log
 from app.utils.retry import retry_with_backoff
 from dotenv import dotenv_values
 
+try:
+    import httpx
+except ImportError:  # 仅模拟模式可在未安装 httpx 时运行
+    httpx = None
+
+try:
+    # pybase64 基于 libbase64，运行时按 CPU 选择 AVX2/AVX-512/NEON 编码实现
+    from pybase64 import b64encode as _b64encode
+except ImportError:  # 未安装时直接调用 binascii（跳过 base64.b64encode 的 Python 层包装）
+    from binascii import b2a_base64
+
+    _b64encode = functools.partial(b2a_base64, newline=False)
+
+
+# TTS 音频读取大小与单次编码上限：编码长度均为 3 的倍数，保证相邻块的 base64 可直接拼接
+_TTS_READ_SIZE = 65536
+_TTS_ENCODE_BLOCK = 49152
+
+
+# 进程级复用的 HTTP 客户端：保持长连接，避免每次合成重新建立 TCP/TLS
+_HTTP_CLIENT = None
+_HTTP_CLIENT_LOCK = threading.Lock()
+
+
+def _get_http_client():
+    """
+    返回进程内共享的 httpx.Client（首次调用时创建，退出时关闭）。
+
+    说明：
+        - 优先启用 HTTP/2（需安装 h2），未安装时回退 HTTP/1.1 keep-alive；
+        - 超时为 None，与流式合成的长响应保持一致；
+        - 未安装 httpx 时抛出 RuntimeError（模拟模式不会调用）。
+    """
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None:
+        if httpx is None:
+            raise RuntimeError("httpx is required for TTS HTTP synthesis; install httpx or set VOICE_USE_MOCK=1")
+        with _HTTP_CLIENT_LOCK:
+            if _HTTP_CLIENT is None:
+                limits = httpx.Limits(max_keepalive_connections=32)
+                try:
+                    client = httpx.Client(timeout=None, http2=True, limits=limits)
+                except ImportError:
+                    client = httpx.Client(timeout=None, limits=limits)
+                atexit.register(client.close)
+                _HTTP_CLIENT = client
+    return _HTTP_CLIENT
+
+
+# 项目根目录的 .env（app/services/ 上两级），导入时解析一次路径
+_ENV_PATH = Path(__file__).resolve().parent.parent.parent / ".env"
+
+
+@functools.lru_cache(maxsize=1)
+def _load_env() -> Dict[str, Optional[str]]:
+    """
+    读取项目根目录 .env 的配置（进程内只解析一次，结果只读共享）。
+
+    说明：
+        - 读取失败返回空字典；
+        - 如需重新读取（例如测试中修改了 .env），调用 `_load_env.cache_clear()`。
+    """
+    try:
+        return dotenv_values(_ENV_PATH) or {}
+    except Exception:
+        return {}
+
 
 class VoiceMockStream:
     """
@@ -12,9 +83,10 @@ class VoiceMockStream:
 
     说明：
         - 仅用于本地开发与无真实服务时的验证（通过 VOICE_USE_MOCK=1 开启）。
+        - 产出 {"b64": bytes}：base64 结果保持为 ASCII 字节，省去 decode 后再由 SSE 层 encode 的往返。
     """
 
-    def __init__(self, text: str, chunk_size: int = 10):
+    def __init__(self, text: str, chunk_size: int = 12):
         self.text = text
         self.chunk_size = chunk_size
 
@@ -23,11 +95,19 @@ class VoiceMockStream:
 
     def events(self) -> Iterable[Dict[str, Any]]:
         data = self.text.encode("utf-8")
+        size = self.chunk_size
+        if size % 3 == 0:
+            # chunk_size 为 3 的倍数时，每个分片的编码结果恰为独立的 base64 块（中间无填充）：
+            # 整体编码一次后按 size//3*4 字节切片，与逐片编码结果一致
+            b64_all = _b64encode(data)
+            step = size // 3 * 4
+            for j in range(0, len(b64_all), step):
+                yield {"b64": b64_all[j : j + step]}
+            return
         # 将文本按 chunk_size 切片并进行 base64 编码，模拟音频数据块
-        for i in range(0, len(data), self.chunk_size):
-            chunk = data[i : i + self.chunk_size]
-            b64 = base64.b64encode(chunk).decode("ascii")
-            yield {"b64": b64}
+        for i in range(0, len(data), size):
+            chunk = data[i : i + size]
+            yield {"b64": _b64encode(chunk)}
 
 
 class VoiceClient:
@@ -57,14 +137,8 @@ class VoiceClient:
             - VOICE_USE_MOCK: 为 '1' 时使用本地模拟流
             - USE_MOCK: 若为 '1'，也强制使用模拟（便于测试统一控制）
         """
-        # 通过文件读取 .env，而不是仅依赖进程环境变量
-        project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
-        env_path = os.path.join(project_root, ".env")
-        env_vars: Dict[str, str] = {}
-        try:
-            env_vars = dotenv_values(env_path) or {}
-        except Exception:
-            env_vars = {}
+        # 通过文件读取 .env（模块级缓存，仅首次解析），而不是仅依赖进程环境变量
+        env_vars = _load_env()
 
         # 优先使用 .env 的值，其次回退到进程环境变量
         self.base_url = env_vars.get("VOICE_CLONE_BASE_URL") or os.environ.get("VOICE_CLONE_BASE_URL", "")
@@ -88,7 +162,7 @@ class VoiceClient:
             audio_format: 音频格式（mp3/wav等），默认 mp3
 
         输出：
-            可迭代对象：每次迭代返回字典 {"b64": "..."}
+            可迭代对象：每次迭代返回字典 {"b64": b"..."}（ASCII 字节，可直接拼接进 SSE 字节帧）
 
         关键逻辑：
             - 若 VOICE_USE_MOCK=1，则返回模拟流。
@@ -103,66 +177,69 @@ class VoiceClient:
             or (os.environ.get("VOICE_USE_MOCK") == "1")
         )
         if runtime_mock or not self.base_url:
-            from app.utils.logger import log_json, setup_logger, get_content_log_config, build_preview
             logger = setup_logger()
-            cfg = get_content_log_config()
             # 可选：记录 TTS 文本预览（受 include_input 控制）
-            if cfg.get("include_input"):
-                pv = build_preview(text, cfg["max_chars"], cfg["redact"])
+            pv = maybe_build_preview("input", text)
+            if pv is not None:
                 log_json(logger, 20, "tts.input.preview", sessionId=session_id, voiceId=voice_id, **pv)
-                from app.utils.logger import write_session_log
                 write_session_log(session_id, "INFO", "tts.input.preview", {"voiceId": voice_id, **pv})
             log_json(logger, 20, "tts.mock.start", sessionId=session_id, voiceId=voice_id, text_len=len(text))
             return VoiceMockStream(text)
 
-        import httpx
-
         # 适配你提供的接口：POST {base}/api/tts/stream，JSON体为 {text, session_id, voice_id?, format?}
-        from app.utils.logger import log_json, setup_logger, get_content_log_config, build_preview
         logger = setup_logger()
-        cfg = get_content_log_config()
-        if cfg.get("include_input"):
-            pv = build_preview(text, cfg["max_chars"], cfg["redact"])
+        pv = maybe_build_preview("input", text)
+        if pv is not None:
             log_json(logger, 20, "tts.input.preview", sessionId=session_id, voiceId=voice_id, **pv)
-            from app.utils.logger import write_session_log
             write_session_log(session_id, "INFO", "tts.input.preview", {"voiceId": voice_id, **pv})
         log_json(logger, 20, "tts.http.start", base_url=self.base_url, sessionId=session_id, voiceId=voice_id, text_len=len(text))
-        with httpx.Client(timeout=None) as client:
-            headers = {
-                "Content-Type": "application/json",
-                "Accept": "application/octet-stream",
-            }
-            if self.api_key:
-                headers["Authorization"] = f"Bearer {self.api_key}"
-            # 按 /api/tts/stream 的 schema 组织请求体
-            payload = {"text": text, "session_id": session_id}
-            if voice_id:
-                # 将上游的 voice_id 映射为 TTS 服务的 voice_type
-                payload["voice_type"] = voice_id
-            # 可选：允许服务端保存副本；此处默认不传递 save_path
-            url = f"{self.base_url.rstrip('/')}/api/tts/stream"
-            with client.stream("POST", url, headers=headers, json=payload) as resp:
-                resp.raise_for_status()
-                # 校验返回的内容类型是否为音频
-                ct = resp.headers.get("content-type", "")
-                log_json(logger, 20, "tts.http.headers", content_type=ct, status=resp.status_code)
-                if not ct.startswith("audio/"):
-                    # 读取部分错误内容用于诊断
-                    preview = ""
+        client = _get_http_client()
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/octet-stream",
+        }
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        # 按 /api/tts/stream 的 schema 组织请求体
+        payload = {"text": text, "session_id": session_id}
+        if voice_id:
+            # 将上游的 voice_id 映射为 TTS 服务的 voice_type
+            payload["voice_type"] = voice_id
+        # 可选：允许服务端保存副本；此处默认不传递 save_path
+        url = f"{self.base_url.rstrip('/')}/api/tts/stream"
+        with client.stream("POST", url, headers=headers, json=payload) as resp:
+            resp.raise_for_status()
+            # 校验返回的内容类型是否为音频
+            ct = resp.headers.get("content-type", "")
+            log_json(logger, 20, "tts.http.headers", content_type=ct, status=resp.status_code)
+            if not ct.startswith("audio/"):
+                # 读取部分错误内容用于诊断
+                preview = ""
+                try:
+                    raw = resp.read()[:256]
                     try:
-                        raw = resp.read()[:256]
-                        try:
-                            preview = raw.decode("utf-8", "ignore")
-                        except Exception:
-                            preview = str(raw)
+                        preview = raw.decode("utf-8", "ignore")
                     except Exception:
-                        preview = ""
-                    log_json(logger, 40, "tts.http.non_audio", status=resp.status_code, content_type=ct, preview=preview)
-                    raise RuntimeError(f"TTS responded non-audio content-type: {ct}, status={resp.status_code}, preview={preview}")
-                for chunk in resp.iter_bytes():
-                    if not chunk:
-                        continue
-                    b64 = base64.b64encode(chunk).decode("ascii")
-                    log_json(logger, 10, "tts.http.chunk", size=len(chunk))
-                    yield {"b64": b64}
-            log_json(logger, 20, "tts.http.completed", sessionId=session_id, voiceId=voice_id)
\ No newline at end of file
+                        preview = str(raw)
+                except Exception:
+                    preview = ""
+                log_json(logger, 40, "tts.http.non_audio", status=resp.status_code, content_type=ct, preview=preview)
+                raise RuntimeError(f"TTS responded non-audio content-type: {ct}, status={resp.status_code}, preview={preview}")
+            # 每收到数据即编码已缓冲的 3 字节对齐前缀（单次最多一个编码块），块间无填充；
+            # 不足 3 字节的余数留待与下一片拼接，不为凑满整块而延迟首个音频块
+            buf = bytearray()
+            for chunk in resp.iter_bytes(chunk_size=_TTS_READ_SIZE):
+                if not chunk:
+                    continue
+                buf += chunk
+                while len(buf) >= 3:
+                    n = min(len(buf) - len(buf) % 3, _TTS_ENCODE_BLOCK)
+                    block = bytes(buf[:n])
+                    del buf[:n]
+                    log_json(logger, 10, "tts.http.chunk", size=n)
+                    yield {"b64": _b64encode(block)}
+            # 流结束：编码剩余字节（末块可含填充）
+            if buf:
+                log_json(logger, 10, "tts.http.chunk", size=len(buf))
+                yield {"b64": _b64encode(bytes(buf))}
+        log_json(logger, 20, "tts.http.completed", sessionId=session_id, voiceId=voice_id)
\ No newline at end of file
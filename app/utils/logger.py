@@ -1,11 +1,53 @@
+import atexit
+import functools
 import logging
 import os
+import queue
 import sys
-from typing import Any, Dict, Optional
-from logging.handlers import RotatingFileHandler
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import re
 from datetime import datetime
 
+import orjson
+
+
+# 允许非字符串键（如数字键），避免结构化上下文退回 repr 格式
+_ORJSON_OPTS = orjson.OPT_NON_STR_KEYS
+
+
+def _dumps(obj: Any) -> str:
+    """
+    将对象序列化为 JSON 文本（orjson，直接输出 UTF-8，无需 ensure_ascii 处理）。
+    """
+    return orjson.dumps(obj, option=_ORJSON_OPTS).decode("utf-8")
+
+
+def _dumps_line(obj: Any) -> bytes:
+    """
+    将对象序列化为以换行结尾的 UTF-8 JSON 字节行。
+    """
+    return orjson.dumps(obj, option=_ORJSON_OPTS | orjson.OPT_APPEND_NEWLINE)
+
+
+# 文件日志队列容量：写盘跟不上时丢弃新记录，而不是阻塞请求线程
+_LOG_QUEUE_SIZE = 10000
+
+
+class _DropOnFullQueueHandler(QueueHandler):
+    """
+    队列已满时静默丢弃记录的 QueueHandler（默认实现会对每条记录打印错误堆栈）。
+    """
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
 
 def setup_logger() -> logging.Logger:
     """
@@ -20,6 +62,7 @@ def setup_logger() -> logging.Logger:
     关键逻辑：
         - 标准输出：始终输出到 stdout，统一格式包含等级、消息；
         - 文件持久化（可选）：当 `LOG_TO_FILE=1` 时，使用按大小滚动的文件记录；
+          文件写入经有界队列交由后台 QueueListener 线程完成，不阻塞调用方；
           配置项：
             - LOG_FILE_PATH：日志文件路径，默认 `/srv/chat/logs/chat.log`；
             - LOG_MAX_BYTES：单文件最大字节数，默认 10_485_760（10MB）；
@@ -70,7 +113,14 @@ def setup_logger() -> logging.Logger:
                 )
                 file_handler.setLevel(level_value)
                 file_handler.setFormatter(formatter)
-                logger.addHandler(file_handler)
+                # 文件写入交给后台 QueueListener 线程，记录日志的线程只做入队
+                log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=_LOG_QUEUE_SIZE)
+                listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+                listener.start()
+                atexit.register(listener.stop)
+                queue_handler = _DropOnFullQueueHandler(log_queue)
+                queue_handler.setLevel(level_value)
+                logger.addHandler(queue_handler)
             except Exception:
                 # 文件句柄创建失败时，退回仅控制台输出
                 pass
@@ -78,17 +128,16 @@ def setup_logger() -> logging.Logger:
         # 设置根记录器等级
         logger.setLevel(level_value)
         try:
-            import json as _json
             # 读取内容日志相关配置以便初始化时可见
             cfg = get_content_log_config()
             logger.info(
                 f"logger.init | "
-                + _json.dumps({
+                + _dumps({
                     "level": level_name,
                     "to_file": os.environ.get("LOG_TO_FILE", "0") == "1",
                     "path": os.environ.get("LOG_FILE_PATH", default_path if 'default_path' in locals() else None),
                     "content": cfg,
-                }, ensure_ascii=False)
+                })
             )
         except Exception:
             pass
@@ -112,14 +161,14 @@ def log_json(logger: logging.Logger, level: int, message: str, **kwargs: Any) ->
         - 将上下文字典序列化为字符串拼接在消息后，便于后续检索。
     """
     try:
-        import json
-        context = json.dumps(kwargs, ensure_ascii=False)
+        context = _dumps(kwargs)
         logger.log(level, f"{message} | {context}")
     except Exception:
         # 回退到普通日志
         logger.log(level, f"{message} | context={kwargs}")
 
 
+@functools.lru_cache(maxsize=1)
 def get_content_log_config() -> Dict[str, Any]:
     """
     读取内容日志相关配置。
@@ -133,6 +182,8 @@ def get_content_log_config() -> Dict[str, Any]:
 
     关键逻辑：
         - 从进程环境变量读取；提供合理默认值；校验 include_output 合法性。
+        - 结果在进程内缓存（环境变量运行期不变），返回的字典只读共享；
+          修改环境变量后需调用 `get_content_log_config.cache_clear()` 重新读取。
     """
     include_input = os.environ.get("LOG_INCLUDE_INPUT", "0") == "1"
     include_output = os.environ.get("LOG_INCLUDE_OUTPUT", "none").lower()
@@ -151,6 +202,30 @@ def get_content_log_config() -> Dict[str, Any]:
     }
 
 
+# 脱敏规则在模块加载时编译一次
+_EMAIL_RE = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+_PHONE_RE = re.compile(r"\b(\+?\d[\d\- ]{7,}\d)\b")
+_SECRET_RE = re.compile(r"(?i)\b(api[_-]?key|token|secret|password)\b\s*[:=]\s*([A-Za-z0-9\-_/]{8,})")
+# 三条规则的合并模式：仅用于单次扫描判断是否需要脱敏（原文均不命中时，顺序替换也不会改变文本）
+_REDACT_ANY_RE = re.compile(
+    r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}"
+    r"|\b\+?\d[\d\- ]{7,}\d\b"
+    r"|(?i:\b(?:api[_-]?key|token|secret|password)\b\s*[:=]\s*[A-Za-z0-9\-_/]{8,})"
+)
+
+
+def _mask_email(m: re.Match) -> str:
+    v = m.group(0)
+    at = v.find("@")
+    if at == -1:
+        return "***@***"
+    name = v[:at]
+    domain = v[at+1:]
+    masked_name = (name[0] + "***") if name else "***"
+    masked_domain = (domain.split(".")[0][:1] + "***") if domain else "***"
+    return f"{masked_name}@{masked_domain}"
+
+
 def _redact_text(text: str) -> str:
     """
     基础脱敏处理：邮箱、手机号、疑似密钥等模式。
@@ -164,30 +239,19 @@ def _redact_text(text: str) -> str:
     关键逻辑：
         - 邮箱：保留用户名首字符与域名首字符，其余以 * 替代；
         - 手机号/长数字串：替换为部分星号；
-        - 可能的密钥：apiKey/token/secret/password 键名后的值进行遮蔽。
+        - 可能的密钥：apiKey/token/secret/password 键名后的值进行遮蔽；
+        - 先用合并模式单次扫描，均不命中（多数日志文本）时直接返回；命中时按邮箱、手机号、密钥顺序替换，
+          后一条规则作用于前一条的结果。
     """
     try:
+        if _REDACT_ANY_RE.search(text) is None:
+            return text
         # 邮箱遮蔽
-        email_pattern = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
-        def _mask_email(m: re.Match) -> str:
-            v = m.group(0)
-            at = v.find("@")
-            if at == -1:
-                return "***@***"
-            name = v[:at]
-            domain = v[at+1:]
-            masked_name = (name[0] + "***") if name else "***"
-            masked_domain = (domain.split(".")[0][:1] + "***") if domain else "***"
-            return f"{masked_name}@{masked_domain}"
-        text = email_pattern.sub(_mask_email, text)
-
+        text = _EMAIL_RE.sub(_mask_email, text)
         # 手机号/长数字串遮蔽（宽松）
-        phone_pattern = re.compile(r"\b(\+?\d[\d\- ]{7,}\d)\b")
-        text = phone_pattern.sub(lambda m: m.group(0)[:3] + "***" + m.group(0)[-2:], text)
-
+        text = _PHONE_RE.sub(lambda m: m.group(0)[:3] + "***" + m.group(0)[-2:], text)
         # 键名后的值遮蔽
-        secret_pattern = re.compile(r"(?i)\b(api[_-]?key|token|secret|password)\b\s*[:=]\s*([A-Za-z0-9\-_/]{8,})")
-        text = secret_pattern.sub(lambda m: m.group(1) + "=***", text)
+        text = _SECRET_RE.sub(lambda m: m.group(1) + "=***", text)
         return text
     except Exception:
         return text
@@ -212,16 +276,181 @@ def build_preview(text: Optional[str], max_chars: int, redact: bool) -> Dict[str
     """
     if not text:
         return {"text_len": 0, "preview": ""}
+    orig_len = len(text)
+    # 快速路径：短文本且不脱敏时原样返回
+    if not redact and orig_len <= max_chars:
+        return {"text_len": orig_len, "preview": text}
     try:
-        src = text
-        if redact:
-            src = _redact_text(src)
+        src = _redact_text(text) if redact else text
         if len(src) > max_chars:
-            return {"text_len": len(text), "preview": src[:max_chars] + "…(截断)"}
-        else:
-            return {"text_len": len(text), "preview": src}
+            return {"text_len": orig_len, "preview": src[:max_chars] + "…(截断)"}
+        return {"text_len": orig_len, "preview": src}
     except Exception:
-        return {"text_len": len(text), "preview": text[:max_chars] + ("…(截断)" if len(text) > max_chars else "")}
+        return {"text_len": orig_len, "preview": text[:max_chars] + ("…(截断)" if orig_len > max_chars else "")}
+
+
+def maybe_build_preview(kind: str, text: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    按内容日志配置决定是否构造预览。
+
+    输入：
+        kind: 预览类别，"input"（受 include_input 控制）、"delta" 或 "final"（受 include_output 控制）
+        text: 原始文本
+
+    输出：
+        Optional[Dict]：对应类别未开启时返回 None（不做长度计算、截断与字典分配），否则同 build_preview。
+    """
+    cfg = get_content_log_config()
+    if kind == "input":
+        enabled = cfg["include_input"]
+    else:
+        enabled = cfg["include_output"] in (kind, "both")
+    if not enabled:
+        return None
+    return build_preview(text, cfg["max_chars"], cfg["redact"])
+
+
+# 会话日志后台写入：生产者仅入队，由单个写线程按批合并追加，避免在事件循环上做磁盘 I/O
+_SESSION_LOG_BATCH = 64
+_SESSION_LOG_FLUSH_INTERVAL = 0.1
+_session_log_queue: "queue.Queue[Optional[Tuple[str, bytes]]]" = queue.Queue()
+_session_log_thread: Optional[threading.Thread] = None
+_session_log_thread_lock = threading.Lock()
+# 写线程持有的会话日志文件句柄（LRU，超出上限时关闭最久未用的句柄）
+_SESSION_LOG_MAX_FDS = 128
+_session_log_fds: "OrderedDict[str, BinaryIO]" = OrderedDict()
+
+
+def _session_log_fd(target_file: str) -> BinaryIO:
+    """
+    获取目标文件的追加句柄：命中则复用，未命中时创建目录并打开。仅在写线程内调用。
+    """
+    f = _session_log_fds.get(target_file)
+    if f is not None:
+        _session_log_fds.move_to_end(target_file)
+        return f
+    os.makedirs(os.path.dirname(target_file), exist_ok=True)
+    f = open(target_file, "ab")
+    _session_log_fds[target_file] = f
+    if len(_session_log_fds) > _SESSION_LOG_MAX_FDS:
+        _, oldest = _session_log_fds.popitem(last=False)
+        try:
+            oldest.close()
+        except Exception:
+            pass
+    return f
+
+
+def _write_session_batch(batch: List[Tuple[str, bytes]]) -> None:
+    """
+    将一批会话日志行按目标文件分组，每个文件整体追加一次并刷新到操作系统。
+    """
+    grouped: Dict[str, List[bytes]] = {}
+    for target_file, line in batch:
+        grouped.setdefault(target_file, []).append(line)
+    for target_file, lines in grouped.items():
+        try:
+            f = _session_log_fd(target_file)
+            f.writelines(lines)
+            f.flush()
+        except Exception:
+            # 静默失败，避免影响主流程；丢弃可能已失效的句柄，下次重新打开
+            stale = _session_log_fds.pop(target_file, None)
+            if stale is not None:
+                try:
+                    stale.close()
+                except Exception:
+                    pass
+
+
+def _session_log_worker() -> None:
+    """
+    后台写线程：阻塞等待首条日志，随后在 flush 间隔内最多收集一批再写入。
+
+    队列中的 None 为刷新哨兵：收到后立即写出当前批次。
+    """
+    q = _session_log_queue
+    while True:
+        item = q.get()
+        batch: List[Tuple[str, bytes]] = []
+        taken = 1
+        if item is not None:
+            batch.append(item)
+            deadline = time.monotonic() + _SESSION_LOG_FLUSH_INTERVAL
+            while len(batch) < _SESSION_LOG_BATCH:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = q.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                taken += 1
+                if item is None:
+                    break
+                batch.append(item)
+        if batch:
+            _write_session_batch(batch)
+        for _ in range(taken):
+            q.task_done()
+
+
+def _ensure_session_log_worker() -> None:
+    global _session_log_thread
+    if _session_log_thread is not None:
+        return
+    with _session_log_thread_lock:
+        if _session_log_thread is None:
+            t = threading.Thread(target=_session_log_worker, name="session-log-writer", daemon=True)
+            t.start()
+            _session_log_thread = t
+            atexit.register(_shutdown_session_logs)
+
+
+def _shutdown_session_logs() -> None:
+    # 进程退出：先等待队列写完，再关闭缓存的句柄
+    flush_session_logs()
+    while _session_log_fds:
+        _, f = _session_log_fds.popitem()
+        try:
+            f.close()
+        except Exception:
+            pass
+
+
+# 时间戳精度为秒：同一秒内的事件复用格式化结果（元组整体替换，多线程读写安全）
+_ts_cache: Tuple[int, str] = (-1, "")
+
+
+def _session_log_timestamp() -> str:
+    global _ts_cache
+    sec = int(time.time())
+    cached = _ts_cache
+    if cached[0] != sec:
+        cached = (sec, datetime.fromtimestamp(sec).astimezone().strftime("%Y-%m-%dT%H:%M:%S%z"))
+        _ts_cache = cached
+    return cached[1]
+
+
+def session_log_enabled() -> bool:
+    """
+    是否开启会话级日志（环境变量 `SESSION_LOG_ENABLED=1`）。
+    """
+    return os.environ.get("SESSION_LOG_ENABLED", "0") == "1"
+
+
+def flush_session_logs() -> None:
+    """
+    阻塞等待已入队的会话日志全部写入磁盘。
+
+    说明：
+        - 等待整个进程级队列清空，持续有写入时可能长时间阻塞；仅用于测试与退出，不应在请求路径调用。
+        - 写线程未启动时直接返回。
+    """
+    if _session_log_thread is None:
+        return
+    _session_log_queue.put(None)
+    _session_log_queue.join()
 
 
 def write_session_log(session_id: Optional[str], level: str, message: str, payload: Dict[str, Any]) -> None:
@@ -240,24 +469,23 @@ def write_session_log(session_id: Optional[str], level: str, message: str, paylo
     关键逻辑：
         - 受环境变量 `SESSION_LOG_ENABLED` 控制，默认关闭；
         - 路径可通过 `SESSION_LOG_BASE_DIR` 配置，默认 `/srv/chat/log`；
-        - 自动创建目录；采用简单追加写入，不做滚动。
+        - 非阻塞：仅格式化并入队，由后台写线程批量追加（自动创建目录，复用文件句柄，不做滚动）；
+        - 需要确保落盘时调用 `flush_session_logs`。
     """
     try:
         if not session_id:
             return
-        if os.environ.get("SESSION_LOG_ENABLED", "0") != "1":
+        if not session_log_enabled():
             return
         base_dir = os.environ.get("SESSION_LOG_BASE_DIR", "/srv/chat/log")
         # 目录：<base>/<sessionId>/，文件：<sessionId>.log
-        target_dir = os.path.join(base_dir, session_id)
-        os.makedirs(target_dir, exist_ok=True)
-        target_file = os.path.join(target_dir, f"{session_id}.log")
-        # 时间戳与消息格式对齐主日志
-        ts = datetime.now().astimezone().strftime("%Y-%m-%dT%H:%M:%S%z")
-        import json
-        line = f"{ts} {level} {message} | " + json.dumps(payload, ensure_ascii=False)
-        with open(target_file, "a", encoding="utf-8") as f:
-            f.write(line + "\n")
+        target_file = os.path.join(base_dir, session_id, f"{session_id}.log")
+        # 时间戳与消息格式对齐主日志（取事件发生时刻，而非写入时刻）
+        ts = _session_log_timestamp()
+        # 行以 UTF-8 字节入队：JSON 部分直接输出字节并追加换行，写线程以二进制追加
+        line = f"{ts} {level} {message} | ".encode("utf-8") + _dumps_line(payload)
+        _ensure_session_log_worker()
+        _session_log_queue.put_nowait((target_file, line))
     except Exception:
         # 静默失败，避免影响主流程
         pass
\ No newline at end of file
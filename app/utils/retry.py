@@ -1,3 +1,5 @@
+import asyncio
+import functools
 import random
 import time
 from typing import Callable, Tuple, Type
@@ -20,10 +22,30 @@ def retry_with_backoff(
         decorator: 可用于装饰函数的装饰器。
 
     关键逻辑：
-        - 对指定异常进行指数退避重试，叠加随机抖动。
+        - 对指定异常进行指数退避重试，叠加 [0, base_delay) 随机抖动；退避序列在装饰时预先计算。
+        - 被装饰对象为协程函数时，使用 asyncio.sleep 退避，避免阻塞事件循环。
     """
 
+    # 指数退避基数在装饰时预先计算：第 n 次失败后等待 base_delay * 2^(n-1)
+    delays = [base_delay * (1 << i) for i in range(max(0, max_attempts - 1))]
+
     def decorator(func: Callable) -> Callable:
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                attempt = 0
+                while True:
+                    try:
+                        return await func(*args, **kwargs)
+                    except exceptions:
+                        attempt += 1
+                        if attempt >= max_attempts:
+                            raise
+                        await asyncio.sleep(delays[attempt - 1] + random.random() * base_delay)
+
+            return async_wrapper
+
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
             attempt = 0
             while True:
@@ -33,9 +55,7 @@ def retry_with_backoff(
                     attempt += 1
                     if attempt >= max_attempts:
                         raise
-                    delay = base_delay * (2 ** (attempt - 1))
-                    delay += random.uniform(0, base_delay)
-                    time.sleep(delay)
+                    time.sleep(delays[attempt - 1] + random.random() * base_delay)
 
         return wrapper
 
@@ -2,11 +2,16 @@ import os
 import pytest
 from fastapi.testclient import TestClient
 from app.main import app
+from app.utils.logger import get_content_log_config, flush_session_logs
 
 
 @pytest.fixture(autouse=True)
 def use_mock_env(monkeypatch):
     monkeypatch.setenv("USE_MOCK", "1")
+    # 内容日志配置按进程缓存：每个用例在设置环境变量后重新读取
+    get_content_log_config.cache_clear()
+    yield
+    get_content_log_config.cache_clear()
 
 
 def test_healthz():
@@ -16,6 +21,18 @@ def test_healthz():
     assert resp.json()["status"] == "ok"
 
 
+def test_prompts_endpoints():
+    from app.services.prompts import PROMPTS
+    client = TestClient(app)
+    resp = client.get("/prompts")
+    assert resp.status_code == 200
+    assert [p["name"] for p in resp.json()["prompts"]] == list(PROMPTS)
+    resp = client.get("/prompts/default")
+    assert resp.status_code == 200
+    assert resp.json() == {"name": "default", "text": PROMPTS["default"]}
+    assert client.get("/prompts/missing").status_code == 404
+
+
 def test_sse_post_handshake_text_only():
     client = TestClient(app)
     resp = client.post("/chat/stream", json={"model": "gpt-4o-mini", "input": "你好", "sessionId": "session-test"}, headers={"Accept": "text/event-stream"})
@@ -30,6 +47,15 @@ def test_sse_post_handshake_text_only():
     assert "event: audio.completed" not in body_text
 
 
+def test_sse_get_handshake():
+    client = TestClient(app)
+    resp = client.get("/chat/stream", params={"input": "你好", "sessionId": "session-get-test"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("text/event-stream")
+    assert "event: content.delta" in resp.text
+    assert "event: response.completed" in resp.text
+
+
 def test_content_logging_preview(monkeypatch):
     """
     验证内容日志预览：开启输入与最终输出预览后，日志中应出现相关记录。
@@ -84,6 +110,8 @@ def test_session_log_files(monkeypatch):
         headers={"Accept": "text/event-stream"},
     )
     assert resp.status_code == 200
+    # 会话日志由后台线程写入，读取前等待落盘
+    flush_session_logs()
     target_file = f"/srv/chat/log/{sid}/{sid}.log"
     # 文件存在并包含输入预览
     assert os.path.isfile(target_file)
@@ -92,6 +120,137 @@ def test_session_log_files(monkeypatch):
     assert "request.input.preview" in content
 
 
+def test_session_history_records_reply():
+    """
+    验证流结束后会话历史写入本轮用户输入与完整助手回复（而非占位文本）。
+    """
+    from app.main import session_store
+    sid = "session-history-ut"
+    client = TestClient(app)
+    resp = client.post("/chat/stream", json={"input": "第一轮", "sessionId": sid})
+    assert resp.status_code == 200
+    history = session_store.get(sid)
+    assert [m["role"] for m in history[-2:]] == ["user", "assistant"]
+    assert history[-2]["content"][0]["text"] == "第一轮"
+    assert history[-1]["content"][0]["text"] == "这是一个模拟流式回复，用于本地验证SSE。"
+
+
+def test_session_history_skips_failed_stream(monkeypatch):
+    """
+    验证上游流中途失败时输出 response.error，且截断的回复不写入会话历史。
+    """
+    import app.main as main
+    from types import SimpleNamespace
+
+    async def failing_stream():
+        yield SimpleNamespace(type="content.delta", data={"delta": "半截"})
+        raise RuntimeError("upstream reset")
+
+    async def fake_astream_response(messages, temperature):
+        return failing_stream()
+
+    monkeypatch.setattr(main.client, "astream_response", fake_astream_response)
+    sid = "session-failed-ut"
+    client = TestClient(app)
+    resp = client.post("/chat/stream", json={"input": "会失败", "sessionId": sid})
+    assert resp.status_code == 200
+    assert "event: response.error" in resp.text
+    assert main.session_store.get(sid) == []
+
+
+def test_session_store_persistence(tmp_path):
+    """
+    验证开启持久化后，新的 SessionStore 实例可从 JSONL 文件恢复历史（窗口限制仍生效）。
+    """
+    from app.services.session_store import SessionStore
+    store = SessionStore(max_rounds=1, persist_dir=str(tmp_path))
+    for i in range(3):
+        store.append("persist-ut", {"role": "user", "content": [{"type": "text", "text": str(i)}]})
+    store.flush()
+    assert (tmp_path / "persist-ut.jsonl").is_file()
+    restored = SessionStore(max_rounds=1, persist_dir=str(tmp_path))
+    assert [m["content"][0]["text"] for m in restored.get("persist-ut")] == ["1", "2"]
+    # 没有持久化文件的会话不读取文件
+    restored._writer.load = lambda session_id: pytest.fail("unexpected file read")
+    assert restored.get("no-such-session") == []
+
+
+def test_session_store_compacts_existing_file_after_restart(tmp_path):
+    """
+    验证重启后续写已有会话文件时，压缩阈值计入文件中已有的行数。
+    """
+    from app.services.session_store import SessionStore
+    msg = {"role": "user", "content": [{"type": "text", "text": "x"}]}
+    store = SessionStore(max_rounds=1, persist_dir=str(tmp_path))
+    for _ in range(4):
+        store.append("compact-ut", msg)
+    store.flush()
+    restarted = SessionStore(max_rounds=1, persist_dir=str(tmp_path))
+    restarted.append("compact-ut", msg)
+    restarted.flush()
+    assert len((tmp_path / "compact-ut.jsonl").read_bytes().splitlines()) == 2
+
+
+def test_session_store_persistence_skips_unserializable(monkeypatch, tmp_path):
+    """
+    验证持久化无法序列化的消息（超过 64 位的整数、孤立代理字符）时请求仍正常完成，且内存历史成对写入。
+    """
+    import app.main as main
+    from app.services.session_store import SessionStore
+    store = SessionStore(persist_dir=str(tmp_path))
+    monkeypatch.setattr(main, "session_store", store)
+    client = TestClient(app)
+    resp = client.post(
+        "/chat/stream",
+        content=b'{"input":"x","sessionId":"big-int","messages":[{"role":"user","n":99999999999999999999}]}',
+        headers={"Content-Type": "application/json"},
+    )
+    assert resp.status_code == 200
+    assert "event: response.completed" in resp.text
+    resp = client.post(
+        "/chat/stream",
+        content=b'{"input":"\\ud800","sessionId":"lone-surrogate"}',
+        headers={"Content-Type": "application/json"},
+    )
+    assert resp.status_code == 200
+    assert "event: response.completed" in resp.text
+    store.flush()
+    assert [m["role"] for m in store.get("lone-surrogate")] == ["user", "assistant"]
+
+
+def test_anonymous_requests_not_persisted(monkeypatch, tmp_path):
+    """
+    验证未传 sessionId 的请求（以服务端生成的 requestId 作为会话键）不写入持久化目录。
+    """
+    import app.main as main
+    from app.services.session_store import SessionStore
+    store = SessionStore(persist_dir=str(tmp_path))
+    monkeypatch.setattr(main, "session_store", store)
+    client = TestClient(app)
+    assert client.post("/chat/stream", json={"input": "匿名"}).status_code == 200
+    history = [{"role": "user", "content": [{"type": "text", "text": "旧"}]}]
+    assert client.post("/chat/stream", json={"input": "匿名", "messages": history}).status_code == 200
+    store.flush()
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("mail a@b.com13800138000", "mail a***@b***138***00"),
+        ("token: 13800138000a@b.com", "token: 1***@b***"),
+        ("call 13800138000, api_key=abcdefgh12", "call 138***00, api_key=***"),
+        ("无敏感内容的普通文本", "无敏感内容的普通文本"),
+    ],
+)
+def test_redact_adjacent_patterns(text, expected):
+    """
+    验证相邻的邮箱+手机号、密钥+邮箱等输入按邮箱、手机号、密钥的顺序脱敏，不遗漏任何一类。
+    """
+    from app.utils.logger import _redact_text
+    assert _redact_text(text) == expected
+
+
 # 已移除行流断句与写入逻辑，相应测试删除
 
 
@@ -109,4 +268,54 @@ def test_voiceclient_env_loading(monkeypatch):
     monkeypatch.setenv("VOICE_USE_MOCK", "0")
     monkeypatch.setenv("USE_MOCK", "1")
     vc = VoiceClient()
-    assert vc.use_mock is True
\ No newline at end of file
+    assert vc.use_mock is True
+
+
+@pytest.mark.parametrize("chunk_size", [12, 7])
+def test_voice_mock_stream_roundtrip(chunk_size):
+    """
+    验证模拟语音流（整体编码切片与逐片编码两条路径）的分片解码后可还原原文。
+    """
+    import base64
+    from app.services.voice_client import VoiceMockStream
+    text = "语音合成模拟文本，用于校验分片。"
+    parts = [base64.b64decode(e["b64"]) for e in VoiceMockStream(text, chunk_size=chunk_size)]
+    assert len(parts) > 1
+    assert b"".join(parts) == text.encode("utf-8")
+
+
+def test_voice_http_stream_encodes_aligned_prefix(monkeypatch):
+    """
+    验证 HTTP 语音流按收到的片段即时输出 base64 块（不等待整块），且拼接后可解码还原音频字节。
+    """
+    import base64
+    import contextlib
+    import app.services.voice_client as voice_client
+    fragments = [b"\x01" * 5, b"\x02" * 7, b"\x03", b"\x04" * 100001, b"\x05" * 2]
+
+    class FakeResponse:
+        headers = {"content-type": "audio/mpeg"}
+        status_code = 200
+
+        def raise_for_status(self):
+            pass
+
+        def iter_bytes(self, chunk_size=None):
+            yield from fragments
+
+    class FakeClient:
+        @contextlib.contextmanager
+        def stream(self, method, url, headers=None, json=None):
+            yield FakeResponse()
+
+    monkeypatch.delenv("USE_MOCK", raising=False)
+    monkeypatch.delenv("VOICE_USE_MOCK", raising=False)
+    monkeypatch.setattr(voice_client, "_get_http_client", lambda: FakeClient())
+    vc = voice_client.VoiceClient()
+    vc.use_mock = False
+    vc.base_url = "http://tts.test"
+    b64 = [e["b64"] for e in vc.synthesize_stream("你好", "voice-ut")]
+    # 首个片段到达即输出对齐前缀，而非等待 48 KiB
+    assert base64.b64decode(b64[0]) == b"\x01" * 3
+    assert all(len(chunk) <= voice_client._TTS_ENCODE_BLOCK // 3 * 4 for chunk in b64)
+    assert base64.b64decode(b"".join(b64)) == b"".join(fragments)
\ No newline at end of file